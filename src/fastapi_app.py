@@ -1,7 +1,20 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import List, Literal, Optional
 import numpy as np
 import pandas as pd
-from fastapi import FastAPI, Query
+from fastapi import Depends, FastAPI, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from openpyxl import load_workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Alignment, numbers
@@ -47,15 +60,168 @@ def get_age_ranges(curr_age_val):
     years = np.arange(current_year, current_year + (max_age - curr_age_val) + 1)
     return ages, years
 
+# ========= SHARED REFERENCE DATA & RESULT CACHE =========
+# Reference tables are parsed once, written as .npy files under shared_data_dir and
+# memory-mapped read-only, so every uvicorn worker on the host shares one copy.
+# The default lives under the user's home, not in the world-writable temp directory.
+shared_data_dir = os.environ.get("SS_SHARED_DATA_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ss_simulator_shared"))
+# Bump when parse_tax_brackets or parse_rmd_table change, so stale arrays are not reused.
+reference_table_version = 1
+# Path of the optional SQLite file that caches simulation results across workers.
+# Leave SS_RESULT_CACHE unset to disable the cache.
+result_cache_path = os.environ.get("SS_RESULT_CACHE")
+# Oldest entries are evicted beyond this many cached results.
+result_cache_max_entries = int(os.environ.get("SS_RESULT_CACHE_MAX_ENTRIES", "10000"))
+# Bump whenever run_claim_strategy, create_master_table or the summary-row layout
+# change, so workers stop serving results stored by older code. Results are stored as
+# JSON, never pickles, so a tampered cache file cannot run code in the workers.
+result_cache_version = 2
+
+reference_tables = {}
+reference_table_digests = {}
+
+def parse_tax_brackets(lines):
+    brackets = []
+    for line in lines:
+        if line.strip() and not line.startswith('#'):
+            parts = line.strip().split(',')
+            if len(parts) == 3:
+                brackets.append((float(parts[0]), float(parts[1]), float(parts[2])))
+    return np.array(brackets, dtype=float).reshape(-1, 3)
+
+def parse_rmd_table(lines):
+    """
+    Returns the Uniform Lifetime Table as divisors indexed by age (0-120), with NaN for
+    ages the table does not list. The "120+" row is stored at index 120.
+    """
+    divisors = np.full(121, np.nan)
+    for line in lines:
+        if line.strip() and not line.startswith('#'):
+            parts = line.strip().split(',')
+            age_val = 120 if parts[0] == "120+" else int(parts[0])
+            divisors[age_val] = float(parts[1])
+    return divisors
+
+def shared_data_dir_is_private():
+    """
+    Creates shared_data_dir owner-only if it is missing. Returns False if it cannot be
+    created, belongs to another user or is writable by others, because tables planted
+    there would be trusted.
+    """
+    try:
+        os.makedirs(shared_data_dir, mode=0o700, exist_ok=True)
+        if not hasattr(os, "getuid"):
+            return True
+        info = os.stat(shared_data_dir)
+    except OSError:
+        return False
+    return info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+def publish_reference_table(name, source_file, parse):
+    """
+    Parses `source_file` and publishes it to shared_data_dir, keyed by the parser
+    version and a digest of the file's contents, unless another worker already has.
+    The table is then attached as a read-only memory map. Returns False if the source
+    file does not exist, or shared_data_dir is not private or cannot be written, in
+    which case callers keep reading the source file.
+    """
+    try:
+        with open(source_file, 'r') as file:
+            text = file.read()
+    except FileNotFoundError:
+        return False
+    if not shared_data_dir_is_private():
+        return False
+    digest = f"v{reference_table_version}_{hashlib.sha256(text.encode()).hexdigest()[:16]}"
+    path = os.path.join(shared_data_dir, f"{name}_{digest}.npy")
+    tmp_path = None
+    try:
+        if not os.path.exists(path):
+            # Write to a private temp file and rename it into place, so concurrent
+            # workers never attach to a half-written table.
+            fd, tmp_path = tempfile.mkstemp(dir=shared_data_dir, suffix=".npy")
+            with os.fdopen(fd, 'wb') as tmp_file:
+                np.save(tmp_file, parse(text.splitlines()))
+            os.replace(tmp_path, path)
+        table = np.load(path, mmap_mode='r')
+    except OSError:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    reference_tables[name] = table
+    reference_table_digests[name] = digest
+    return True
+
+def publish_reference_tables():
+    publish_reference_table("tax_brackets", 'tax_brackets_2024.txt', parse_tax_brackets)
+    publish_reference_table("rmd_divisors", 'irs_uniform_lifetime_table.txt', parse_rmd_table)
+
+def load_tax_brackets():
+    if "tax_brackets" in reference_tables:
+        return reference_tables["tax_brackets"]
+    with open('tax_brackets_2024.txt', 'r') as file:
+        return parse_tax_brackets(file)
+
+def load_rmd_divisors():
+    if "rmd_divisors" in reference_tables:
+        return reference_tables["rmd_divisors"]
+    with open('irs_uniform_lifetime_table.txt', 'r') as file:
+        return parse_rmd_table(file)
+
+def make_cache_key(claim_age, fra_benefit, curr_age):
+    """Hashes every input that affects a claim-age simulation."""
+    inputs = {
+        "claim_age": claim_age,
+        "fra_benefit": fra_benefit,
+        "current_age": curr_age,
+        "inflation_rate": inflation_rate,
+        "investment_return": investment_return,
+        "initial_401k": initial_401k,
+        "other_non_retirement_savings": other_non_retirement_savings,
+        "target_income": target_income,
+        "non_retirement_gain_percentage": non_retirement_gain_percentage,
+        "standard_deduction": standard_deduction,
+        "benefit_reduction_factor": benefit_reduction_factor,
+        "trust_fund_depletion_year": trust_fund_depletion_year,
+        "current_year": current_year,
+        "max_age": max_age,
+        "reference_tables": reference_table_digests,
+        "cache_version": result_cache_version
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=float).encode()).hexdigest()
+
+def connect_result_cache():
+    conn = sqlite3.connect(result_cache_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS simulation_results (key TEXT PRIMARY KEY, version INTEGER, created REAL, value TEXT)")
+    return conn
+
+def result_cache_get(key):
+    """Returns the JSON value cached under `key` by the current cache version, or None."""
+    conn = connect_result_cache()
+    try:
+        row = conn.execute("SELECT value FROM simulation_results WHERE key = ? AND version = ?", (key, result_cache_version)).fetchone()
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row else None
+
+def result_cache_set(key, value):
+    conn = connect_result_cache()
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO simulation_results (key, version, created, value) VALUES (?, ?, ?, ?)",
+                         (key, result_cache_version, time.time(), json.dumps(value, default=float)))
+            # Drop results from other code versions, then the oldest beyond the bound.
+            conn.execute("DELETE FROM simulation_results WHERE version != ?", (result_cache_version,))
+            conn.execute("DELETE FROM simulation_results WHERE key NOT IN "
+                         "(SELECT key FROM simulation_results ORDER BY created DESC, rowid DESC LIMIT ?)",
+                         (result_cache_max_entries,))
+    finally:
+        conn.close()
+
 def calculate_federal_income_tax(taxable_income):
     try:
-        brackets = []
-        with open('tax_brackets_2024.txt', 'r') as file:
-            for line in file:
-                if line.strip() and not line.startswith('#'):
-                    parts = line.strip().split(',')
-                    if len(parts) == 3:
-                        brackets.append((float(parts[0]), float(parts[1]), float(parts[2])))
+        brackets = load_tax_brackets()
         tax = 0
         for lower, upper, rate in brackets:
             if taxable_income <= lower:
@@ -89,14 +255,10 @@ def calculate_rmd(age, account_balance):
     if age < 73:
         return 0
     try:
-        rmd_table = {}
-        with open('irs_uniform_lifetime_table.txt', 'r') as file:
-            for line in file:
-                if line.strip() and not line.startswith('#'):
-                    parts = line.strip().split(',')
-                    age_val = 120 if parts[0] == "120+" else int(parts[0])
-                    rmd_table[age_val] = float(parts[1])
-        divisor = rmd_table.get(age, rmd_table.get(120, max(1, 90 - age)))
+        divisors = load_rmd_divisors()
+        divisor = divisors[age] if age <= 120 and not np.isnan(divisors[age]) else divisors[120]
+        if np.isnan(divisor):
+            divisor = max(1, 90 - age)
     except FileNotFoundError:
         divisor = max(1, 90 - age)
     return account_balance / divisor
@@ -216,38 +378,404 @@ def create_master_table(ages, years, ss_benefit, p_values, w401k, wnr, nr, incom
     }
     return pd.DataFrame(master_table)
 
-# ========= FASTAPI APP SETUP =========
-app = FastAPI()
+# ========= BATCHED ENGINE =========
+# Vectorized versions of the helpers above. Each works on many scenarios at once, so
+# one pass over the years replaces a separate run_claim_strategy call per scenario.
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+def calculate_federal_income_tax_batch(taxable_income):
+    taxable_income = np.asarray(taxable_income, dtype=float)
+    try:
+        brackets = load_tax_brackets()
+    except FileNotFoundError:
+        return taxable_income * 0.24
+    tax = np.zeros_like(taxable_income)
+    for lower, upper, rate in brackets:
+        tax += np.clip(taxable_income - lower, 0, upper - lower) * rate
+    return tax
 
-@app.get("/analyze")
-def analyze(
-    session_id: str = Query(...),
-    birthdate: str = Query(...),
-    age_model1: int = Query(...),
-    age_model2: int = Query(...),
-    fra_benefit: float = Query(...),
-    inflation_rate_input: float = Query(...),
-    investment_return_input: float = Query(...),
-    filing_status: str = Query(...),
-    initial_401k_input: float = Query(...),
-    other_non_retirement_savings_input: float = Query(...),
-    target_income_input: float = Query(...),
-    non_retirement_gain_percentage_input: float = Query(...)
+def taxable_social_security_batch(ss_income, provisional_income):
+    return np.where(
+        provisional_income <= 32000,
+        0,
+        np.where(
+            provisional_income <= 44000,
+            np.minimum(ss_income * 0.5, (provisional_income - 32000) * 0.5),
+            np.minimum(ss_income * 0.85, (6000)*0.5 + (provisional_income - 44000) * 0.85)))
+
+def estimate_pre_tax_income_needed_batch(after_tax_target, ss_income):
+    pre_tax_income = after_tax_target * 1.3
+    for _ in range(5):
+        provisional_income = (ss_income * 0.5) + (pre_tax_income - ss_income)
+        taxable_ss = taxable_social_security_batch(ss_income, provisional_income)
+        taxable_income = np.maximum(0, (pre_tax_income - ss_income) + taxable_ss - standard_deduction)
+        tax_estimate = calculate_federal_income_tax_batch(taxable_income)
+        pre_tax_income = after_tax_target + tax_estimate
+    return pre_tax_income, tax_estimate
+
+def run_claim_strategy_batch(ages, curr_age, claim_ages, benefits, inflation_rates, investment_returns, target_incomes, reduction_factors):
+    """
+    Runs run_claim_strategy for S scenarios at once. Every argument after curr_age is an
+    array of length S holding that scenario's value, in place of the module-level
+    parameter run_claim_strategy reads. Returns the same six series as
+    run_claim_strategy, each shaped (S, len(ages)).
+    """
+    claim_ages = np.asarray(claim_ages)
+    benefits = np.asarray(benefits, dtype=float)
+    inflation_rates = np.asarray(inflation_rates, dtype=float)
+    investment_returns = np.asarray(investment_returns, dtype=float)
+    target_incomes = np.asarray(target_incomes, dtype=float)
+    reduction_factors = np.asarray(reduction_factors, dtype=float)
+    shape = (len(claim_ages), len(ages))
+
+    withdrawals_401k = np.zeros(shape)
+    withdrawals_non_retirement = np.zeros(shape)
+    cumulative = np.zeros(shape)
+    portfolio = np.zeros(shape)
+    income_taxes_paid = np.zeros(shape)
+    portfolio[:, 0] = initial_401k
+    non_retirement_savings = np.zeros(shape)
+    non_retirement_savings[:, 0] = other_non_retirement_savings
+    real_return = (1 + investment_returns) / (1 + inflation_rates) - 1
+
+    for i in range(len(ages)):
+        age = ages[i]
+        year = current_year + (age - curr_age)
+        adj_benefit = benefits * reduction_factors if year >= trust_fund_depletion_year else benefits
+        claimed = age >= claim_ages
+        ss_income = np.where(claimed, adj_benefit, 0)
+        previous = cumulative[:, i-1] if i > 0 else 0
+        cumulative[:, i] = np.where(claimed, previous + adj_benefit, 0)
+        if i > 0:
+            pre_tax_income, tax_est = estimate_pre_tax_income_needed_batch(target_incomes, ss_income)
+            income_taxes_paid[:, i] = tax_est
+            income_need = np.maximum(0, pre_tax_income - ss_income)
+            portfolio_prev = portfolio[:, i-1]
+            non_ret_prev = non_retirement_savings[:, i-1]
+            growth = (1 + inflation_rates) ** i
+            rmd_real = calculate_rmd(age, portfolio_prev * growth) / growth
+            excess_deposit = np.where(rmd_real > income_need, rmd_real - income_need, 0)
+            remaining_need = np.where(rmd_real > income_need, 0, income_need - rmd_real)
+            add_from_401k = np.where((remaining_need > 0) & (portfolio_prev > rmd_real),
+                                     np.minimum(remaining_need, portfolio_prev - rmd_real), 0)
+            withdrawals_401k[:, i] = rmd_real + add_from_401k
+            remaining_need = remaining_need - add_from_401k
+            from_non_ret = np.where((remaining_need > 0) & (non_ret_prev > 0),
+                                    np.minimum(remaining_need, non_ret_prev), 0)
+            withdrawals_non_retirement[:, i] = from_non_ret
+            remaining_need = remaining_need - from_non_ret
+            add_more = np.where(remaining_need > 0,
+                                np.minimum(remaining_need, portfolio_prev - withdrawals_401k[:, i]), 0)
+            withdrawals_401k[:, i] += add_more
+            portfolio[:, i] = np.maximum(0, portfolio_prev * (1 + real_return) - withdrawals_401k[:, i])
+            non_retirement_savings[:, i] = np.maximum(0, non_ret_prev * (1 + real_return) - from_non_ret + excess_deposit)
+    return cumulative, portfolio, withdrawals_401k, withdrawals_non_retirement, non_retirement_savings, income_taxes_paid
+
+def run_sensitivity_analysis(claim_ages, fra_benefit, curr_age, perturbation):
+    """
+    Moves each sensitivity input down and up by `perturbation` (a fraction of its base
+    value) for every claiming age, and runs all of those scenarios in one
+    run_claim_strategy_batch call. For each input, returns the final portfolio, the
+    lifetime taxes and their elasticities: the percent change in the output per
+    percent change in the input. benefit_reduction_factor is capped at 1.0, since
+    post-depletion benefits cannot exceed scheduled benefits. Inputs are ranked by final-portfolio swing, largest
+    first, ready for a tornado chart.
+    """
+    base_values = {
+        "inflation_rate": inflation_rate,
+        "investment_return": investment_return,
+        "target_income": target_income,
+        "fra_benefit": fra_benefit,
+        "benefit_reduction_factor": benefit_reduction_factor
+    }
+    # Scenario layout per claim age: the base case, then (down, up) for each input.
+    scenarios = []
+    for claim_age in claim_ages:
+        scenarios.append(dict(base_values, claim_age=claim_age))
+        for name, value in base_values.items():
+            for direction in (-1, 1):
+                perturbed = value * (1 + direction * perturbation)
+                if name == "benefit_reduction_factor":
+                    perturbed = min(perturbed, 1.0)
+                scenarios.append(dict(base_values, claim_age=claim_age, **{name: perturbed}))
+
+    def column(key):
+        return np.array([scenario[key] for scenario in scenarios])
+
+    ages_local, _ = get_age_ranges(curr_age)
+    _, p_values, _, _, nr, taxes = run_claim_strategy_batch(
+        ages_local, curr_age, column("claim_age"),
+        [compute_adjusted_benefit(scenario["fra_benefit"], scenario["claim_age"]) for scenario in scenarios],
+        column("inflation_rate"), column("investment_return"),
+        column("target_income"), column("benefit_reduction_factor"))
+    final_portfolio = p_values[:, -1] + nr[:, -1]
+    lifetime_taxes = taxes.sum(axis=1)
+
+    def elasticity(low, high, base, input_change):
+        # Percent changes are meaningless once an output is (all but) zero, e.g. a depleted
+        # portfolio, or when the input cannot move, e.g. a zero base or a capped factor.
+        if abs(base) < 1 or input_change == 0:
+            return None
+        return float((high - low) / base / input_change)
+
+    results = []
+    per_claim_age = 1 + 2 * len(base_values)
+    for n, claim_age in enumerate(claim_ages):
+        base = n * per_claim_age
+        inputs = []
+        for k, (name, value) in enumerate(base_values.items()):
+            low, high = base + 1 + 2 * k, base + 2 + 2 * k
+            # Relative change actually applied, which is less than 2 * perturbation when capped.
+            input_change = (scenarios[high][name] - scenarios[low][name]) / value if value else 0
+            inputs.append({
+                "input": name,
+                "base_value": value,
+                "low_value": scenarios[low][name],
+                "high_value": scenarios[high][name],
+                "final_portfolio_low": float(final_portfolio[low]),
+                "final_portfolio_high": float(final_portfolio[high]),
+                "lifetime_taxes_low": float(lifetime_taxes[low]),
+                "lifetime_taxes_high": float(lifetime_taxes[high]),
+                "final_portfolio_elasticity": elasticity(final_portfolio[low], final_portfolio[high], final_portfolio[base], input_change),
+                "lifetime_taxes_elasticity": elasticity(lifetime_taxes[low], lifetime_taxes[high], lifetime_taxes[base], input_change)
+            })
+        inputs.sort(key=lambda item: abs(item["final_portfolio_high"] - item["final_portfolio_low"]), reverse=True)
+        results.append({
+            "claim_age": claim_age,
+            "final_portfolio": float(final_portfolio[base]),
+            "lifetime_taxes": float(lifetime_taxes[base]),
+            "inputs": inputs
+        })
+    return results
+
+# ========= WITHDRAWAL & ROTH CONVERSION OPTIMIZER =========
+# Cost per real dollar of after-tax target income the accounts cannot cover.
+shortfall_penalty = 10.0
+
+def income_tax_on_withdrawals(withdrawal_401k, withdrawal_non_ret, ss_income):
+    """
+    Federal tax on a year's 401(k) and non-retirement withdrawals. 401(k) withdrawals
+    are ordinary income, the gain share of non-retirement withdrawals is taxed the way
+    create_master_table does it, and taxable Social Security is added on top.
+    """
+    ordinary_income = withdrawal_401k + withdrawal_non_ret * non_retirement_gain_percentage
+    provisional_income = ordinary_income + ss_income * 0.5
+    taxable_ss = taxable_social_security_batch(ss_income, provisional_income)
+    taxable_income = np.maximum(0, ordinary_income + taxable_ss - standard_deduction)
+    return calculate_federal_income_tax_batch(taxable_income)
+
+def fund_spending(withdrawal_401k, ss_income):
+    """
+    Given 401(k) withdrawals, returns the non-retirement withdrawal still needed to
+    reach target_income after tax, the after-tax surplus deposited into non-retirement
+    savings and the year's tax.
+    """
+    withdrawal_401k = np.asarray(withdrawal_401k, dtype=float)
+    withdrawal_non_ret = np.zeros_like(withdrawal_401k)
+    for _ in range(5):
+        tax = income_tax_on_withdrawals(withdrawal_401k, withdrawal_non_ret, ss_income)
+        withdrawal_non_ret = np.maximum(0, target_income - (withdrawal_401k + ss_income - tax))
+    tax = income_tax_on_withdrawals(withdrawal_401k, withdrawal_non_ret, ss_income)
+    surplus = np.maximum(0, withdrawal_401k + ss_income + withdrawal_non_ret - tax - target_income)
+    return withdrawal_non_ret, surplus, tax
+
+def optimize_withdrawals(claim_age, fra_benefit, curr_age, objective="terminal_wealth", grid_points=41, withdrawal_points=81):
+    """
+    Chooses each year's 401(k) withdrawal by dynamic programming over a grid of
+    (401k, non-retirement) balances, instead of the fixed RMD -> 401(k) ->
+    non-retirement order in run_claim_strategy. Non-retirement savings cover whatever
+    the 401(k) withdrawal leaves short of target_income. Withdrawing beyond that is a
+    Roth-style conversion: tax is paid now and the after-tax amount is deposited in
+    non-retirement savings, the same way run_claim_strategy handles surplus RMDs. The
+    model has no separate Roth account.
+
+    Withdrawal choices come from a fixed grid plus the amount that exactly funds
+    spending, each clamped to at least the RMD and at most the balance. Every
+    (state, choice) pair of a year is evaluated in one array operation, with the value
+    of the next state read by bilinear interpolation. Taxes depend only on the
+    withdrawal and the Social Security income, so they are tabulated once per distinct
+    benefit level and interpolated after that.
+
+    objective is "terminal_wealth", meaning non-retirement savings plus the 401(k) net
+    of tax_bracket at the end, or "lifetime_tax", meaning total tax paid. Shortfalls
+    against target_income are penalised in both. "baseline" in the result is the fixed
+    withdrawal order replayed under the same tax rules. Both are scored on objective
+    and the better one is returned; "policy" says which.
+    """
+    ages_local, years_local = get_age_ranges(curr_age)
+    benefit = compute_adjusted_benefit(fra_benefit, claim_age)
+    ss_income = np.array([adjust_benefit_for_cbo_projections(benefit, age, curr_age) if age >= claim_age else 0 for age in ages_local])
+    growth = (1 + investment_return) / (1 + inflation_rate)
+    horizon_growth = max(1, growth) ** (len(ages_local) - 1)
+    grid_401k = np.linspace(0, max(1, initial_401k * horizon_growth), grid_points)
+    grid_non_ret = np.linspace(0, max(1, (initial_401k + other_non_retirement_savings) * horizon_growth), grid_points)
+    withdrawal_grid = np.linspace(0, max(3 * target_income, grid_401k[-1] / 10), withdrawal_points)
+    withdrawal_table = np.linspace(0, grid_401k[-1] * growth, 4001)
+
+    @lru_cache(maxsize=None)
+    def spending_table(ss):
+        return fund_spending(withdrawal_table, ss)
+
+    @lru_cache(maxsize=None)
+    def spending_withdrawal(ss):
+        # Smallest 401(k) withdrawal that covers target_income without non-retirement savings.
+        non_ret_needed = spending_table(ss)[0]
+        covered = np.nonzero(non_ret_needed <= 0)[0]
+        if len(covered) == 0:
+            return withdrawal_table[-1]
+        k = covered[0]
+        if k == 0:
+            return 0.0
+        step = withdrawal_table[k] - withdrawal_table[k - 1]
+        return withdrawal_table[k - 1] + step * non_ret_needed[k - 1] / (non_ret_needed[k - 1] - non_ret_needed[k])
+
+    def tabulated_spending(withdrawals, ss):
+        return tuple(np.interp(withdrawals, withdrawal_table, column) for column in spending_table(ss))
+
+    def interpolate(values, balance_401k, balance_non_ret):
+        # Bilinear on the uniform grids; balances past the top of a grid extrapolate linearly.
+        x = np.maximum(balance_401k / grid_401k[1], 0)
+        y = np.maximum(balance_non_ret / grid_non_ret[1], 0)
+        i = np.minimum(x.astype(int), grid_points - 2)
+        j = np.minimum(y.astype(int), grid_points - 2)
+        wx, wy = x - i, y - j
+        corner = i * grid_points + j
+        flat = values.ravel()
+        return ((np.take(flat, corner) * (1 - wx) + np.take(flat, corner + grid_points) * wx) * (1 - wy)
+                + (np.take(flat, corner + 1) * (1 - wx) + np.take(flat, corner + grid_points + 1) * wx) * wy)
+
+    def choice_values(value_next, age, ss, balance_401k, balance_non_ret, spending):
+        # Axes: current 401(k) balance, withdrawal choice, current non-retirement balance.
+        # Withdrawing exactly what spending needs is always one of the choices.
+        available = balance_401k * growth
+        rmd = np.minimum(calculate_rmd(age, balance_401k), available)
+        candidates = np.append(withdrawal_grid, spending_withdrawal(ss))
+        withdrawals = np.minimum(np.maximum(candidates, rmd), available)
+        non_ret_needed, surplus, tax = spending(withdrawals)
+        from_non_ret = np.minimum(non_ret_needed[..., None], np.maximum(0, balance_non_ret))
+        shortfall = non_ret_needed[..., None] - from_non_ret
+        next_401k = (available - withdrawals)[..., None]
+        # Clamped at zero like run_claim_strategy, since a negative real return can
+        # shrink the balance below what was withdrawn from it.
+        next_non_ret = np.maximum(0, balance_non_ret * growth - from_non_ret + surplus[..., None])
+        reward = -shortfall_penalty * shortfall
+        if objective == "lifetime_tax":
+            reward = reward - tax[..., None]
+        return reward + interpolate(value_next, next_401k, next_non_ret), withdrawals
+
+    # Backward induction. values[i] is the best value from the end of year i onwards.
+    values = np.zeros((len(ages_local), grid_points, grid_points))
+    if objective == "terminal_wealth":
+        values[-1] = grid_401k[:, None] * (1 - tax_bracket) + grid_non_ret[None, :]
+    for i in range(len(ages_local) - 1, 0, -1):
+        choice, _ = choice_values(
+            values[i], ages_local[i], ss_income[i], grid_401k[:, None], grid_non_ret,
+            lambda withdrawals: tabulated_spending(withdrawals, ss_income[i]))
+        values[i - 1] = choice.max(axis=1)
+
+    def optimal_withdrawal(i, balance_401k, balance_non_ret):
+        choice, withdrawals = choice_values(
+            values[i], ages_local[i], ss_income[i], balance_401k, np.array([balance_non_ret]),
+            lambda withdrawals: fund_spending(withdrawals, ss_income[i]))
+        return withdrawals[np.argmax(choice[:, 0])]
+
+    def fixed_order_withdrawal(i, balance_401k, balance_non_ret):
+        # RMD first, then enough 401(k) to cover target_income, then non-retirement savings.
+        available = balance_401k * growth
+        rmd = min(calculate_rmd(ages_local[i], balance_401k), available)
+        return min(max(rmd, spending_withdrawal(ss_income[i])), available)
+
+    def simulate(choose_withdrawal):
+        # Replays a withdrawal policy from the actual starting balances, with exact taxes.
+        balance_401k, balance_non_ret = float(initial_401k), float(other_non_retirement_savings)
+        schedule = [{
+            "Age": ages_local[0],
+            "Year": years_local[0],
+            "Social Security (2025$)": ss_income[0],
+            "RMDs (2025$)": 0.0,
+            "401k Withdrawals (2025$)": 0.0,
+            "Non-Retirement Withdrawals (2025$)": 0.0,
+            "Conversion Deposited (2025$)": 0.0,
+            "Income Tax (2025$)": 0.0,
+            "Shortfall (2025$)": 0.0,
+            "401k Balance (2025$)": balance_401k,
+            "Non-Retirement Balance (2025$)": balance_non_ret,
+            "Total Portfolio (2025$)": balance_401k + balance_non_ret
+        }]
+        for i in range(1, len(ages_local)):
+            withdrawal = float(choose_withdrawal(i, balance_401k, balance_non_ret))
+            available = balance_401k * growth
+            rmd = min(calculate_rmd(ages_local[i], balance_401k), available)
+            non_ret_needed, surplus, tax = (float(v[0]) for v in fund_spending(np.array([withdrawal]), ss_income[i]))
+            # Only the surplus beyond what the RMD alone would have produced is voluntary.
+            rmd_surplus = float(fund_spending(np.array([rmd]), ss_income[i])[1][0])
+            from_non_ret = min(non_ret_needed, max(0, balance_non_ret))
+            balance_401k = available - withdrawal
+            balance_non_ret = max(0, balance_non_ret * growth - from_non_ret + surplus)
+            schedule.append({
+                "Age": ages_local[i],
+                "Year": years_local[i],
+                "Social Security (2025$)": ss_income[i],
+                "RMDs (2025$)": rmd,
+                "401k Withdrawals (2025$)": withdrawal,
+                "Non-Retirement Withdrawals (2025$)": from_non_ret,
+                "Conversion Deposited (2025$)": max(0, surplus - rmd_surplus),
+                "Income Tax (2025$)": tax,
+                "Shortfall (2025$)": non_ret_needed - from_non_ret,
+                "401k Balance (2025$)": balance_401k,
+                "Non-Retirement Balance (2025$)": balance_non_ret,
+                "Total Portfolio (2025$)": balance_401k + balance_non_ret
+            })
+        return pd.DataFrame(schedule)
+
+    def summarize(df):
+        final = df.iloc[-1]
+        return {
+            "final_portfolio": float(final["Total Portfolio (2025$)"]),
+            "after_tax_terminal_wealth": float(final["401k Balance (2025$)"] * (1 - tax_bracket) + final["Non-Retirement Balance (2025$)"]),
+            "lifetime_taxes": float(df["Income Tax (2025$)"].sum()),
+            "total_shortfall": float(df["Shortfall (2025$)"].sum())
+        }
+
+    def score(summary):
+        penalty = shortfall_penalty * summary["total_shortfall"]
+        if objective == "lifetime_tax":
+            return -summary["lifetime_taxes"] - penalty
+        return summary["after_tax_terminal_wealth"] - penalty
+
+    optimized = simulate(optimal_withdrawal)
+    # The fixed withdrawal order, under the same tax rules, for a like-for-like comparison.
+    fixed_order = simulate(fixed_order_withdrawal)
+    baseline = summarize(fixed_order)
+    # Grid interpolation can leave the optimized policy marginally behind the fixed order.
+    policy, schedule, summary = "optimized", optimized, summarize(optimized)
+    if score(baseline) > score(summary):
+        policy, schedule, summary = "fixed_order", fixed_order, baseline
+    return {
+        "claim_age": claim_age,
+        "objective": objective,
+        "policy": policy,
+        **summary,
+        "score": score(summary),
+        "baseline": dict(baseline, score=score(baseline)),
+        "schedule": schedule.to_dict(orient="records")
+    }
+
+def set_simulation_parameters(
+    birthdate,
+    inflation_rate_input,
+    investment_return_input,
+    filing_status,
+    initial_401k_input,
+    other_non_retirement_savings_input,
+    target_income_input,
+    non_retirement_gain_percentage_input
 ):
-    # Declare all globals at the start
+    """
+    Publishes the user inputs as the module-level parameters read by the simulation
+    helpers and returns the current age computed from the birthdate.
+    """
     global inflation_rate, investment_return, initial_401k, target_income, non_retirement_gain_percentage, tax_bracket, standard_deduction, current_age, other_non_retirement_savings
 
-    # Set variables; note that other_retirement_income_input has been removed so we use a default.
-    other_retirement_income = 0.0  # default value; remove if unused
-    
     inflation_rate = inflation_rate_input
     investment_return = investment_return_input
     initial_401k = initial_401k_input
@@ -273,51 +801,64 @@ def analyze(
     }
     standard_deduction = standard_deduction_map.get(filing_status, 13850)
     
+    current_age = get_current_age(birthdate)
+    return current_age
+
+def get_current_age(birthdate):
     # Compute current age from birthdate (assuming current_year = 2025)
     birth_dt = datetime.strptime(birthdate, "%Y-%m-%d")
-    computed_current_age = current_year - birth_dt.year
-    current_age = computed_current_age
-
-    ages_local, years_local = get_age_ranges(computed_current_age)
-    
-    # Compute adjusted monthly benefits for each model.
-    benefit_model1 = compute_adjusted_benefit(fra_benefit, age_model1)
-    benefit_model2 = compute_adjusted_benefit(fra_benefit, age_model2)
-    
-    c_model1, p_model1, w401k_model1, wnr_model1, nr_model1, taxes_model1 = run_claim_strategy(
-        ages_local, years_local, age_model1, benefit_model1, computed_current_age)
-    c_model2, p_model2, w401k_model2, wnr_model2, nr_model2, taxes_model2 = run_claim_strategy(
-        ages_local, years_local, age_model2, benefit_model2, computed_current_age)
-    
-    ss_model1 = np.zeros(len(ages_local))
-    ss_model2 = np.zeros(len(ages_local))
-    for i in range(len(ages_local)):
-        if ages_local[i] >= age_model1:
-            factor = benefit_reduction_factor if years_local[i] >= trust_fund_depletion_year else 1
-            ss_model1[i] = benefit_model1 * factor
-        if ages_local[i] >= age_model2:
-            factor = benefit_reduction_factor if years_local[i] >= trust_fund_depletion_year else 1
-            ss_model2[i] = benefit_model2 * factor
+    return current_year - birth_dt.year
 
+def get_benefit_percentage(years_local):
     benefit_percentage = np.ones(len(years_local)) * 100
     depletion_index = np.where(years_local >= trust_fund_depletion_year)[0][0] if any(years_local >= trust_fund_depletion_year) else len(years_local)
     benefit_percentage[depletion_index:] = benefit_reduction_factor * 100
+    return benefit_percentage
 
-    df_model1 = create_master_table(ages_local, years_local, ss_model1, p_model1, w401k_model1, wnr_model1, nr_model1, taxes_model1, benefit_percentage, age_model1)
-    df_model2 = create_master_table(ages_local, years_local, ss_model2, p_model2, w401k_model2, wnr_model2, nr_model2, taxes_model2, benefit_percentage, age_model2)
-    
-    excel_file = f"social_security_analysis_{session_id}.xlsx"
+def simulate_claim_age(claim_age, fra_benefit, ages_local, years_local, curr_age, benefit_percentage):
+    """
+    Runs one claiming strategy end to end and returns its master table together with
+    the row it contributes to the "Summary Comparison" sheet.
+    """
+    cache_key = None
+    if result_cache_path:
+        cache_key = make_cache_key(claim_age, fra_benefit, curr_age)
+        cached = result_cache_get(cache_key)
+        if cached is not None:
+            return pd.DataFrame(**cached["table"]), cached["summary_row"]
+
+    benefit = compute_adjusted_benefit(fra_benefit, claim_age)
+    c_values, p_values, w401k, wnr, nr, taxes = run_claim_strategy(
+        ages_local, years_local, claim_age, benefit, curr_age)
+
+    ss_benefit = np.zeros(len(ages_local))
+    for i in range(len(ages_local)):
+        if ages_local[i] >= claim_age:
+            factor = benefit_reduction_factor if years_local[i] >= trust_fund_depletion_year else 1
+            ss_benefit[i] = benefit * factor
+
+    df = create_master_table(ages_local, years_local, ss_benefit, p_values, w401k, wnr, nr, taxes, benefit_percentage, claim_age)
+    summary_row = {
+        "Claiming Age": claim_age,
+        "Monthly Benefit": benefit,
+        "Final 401k Balance": p_values[-1],
+        "Final Non-Retirement": nr[-1],
+        "Final Portfolio Total": p_values[-1] + nr[-1],
+        "Total Taxes Paid": sum(taxes)
+    }
+    if cache_key:
+        result_cache_set(cache_key, {"table": df.to_dict(orient="split"), "summary_row": summary_row})
+    return df, summary_row
+
+def write_excel_report(excel_file, tables, summary_rows):
+    """
+    Writes one sheet per claiming age plus the "Summary Comparison" sheet and applies
+    the dollar formatting. `tables` maps claim age to its master table.
+    """
     with pd.ExcelWriter(excel_file, engine='openpyxl') as writer:
-        df_model1.to_excel(writer, sheet_name=f"Claim SS benefits at age {age_model1}", index=False)
-        df_model2.to_excel(writer, sheet_name=f"Claim SS benefits at age {age_model2}", index=False)
-        summary_data = {
-            "Claiming Age": [age_model1, age_model2],
-            "Monthly Benefit": [benefit_model1, benefit_model2],
-            "Final 401k Balance": [p_model1[-1], p_model2[-1]],
-            "Final Non-Retirement": [nr_model1[-1], nr_model2[-1]],
-            "Final Portfolio Total": [p_model1[-1] + nr_model1[-1], p_model2[-1] + nr_model2[-1]],
-            "Total Taxes Paid": [sum(taxes_model1), sum(taxes_model2)]
-        }
+        for claim_age, df in tables.items():
+            df.to_excel(writer, sheet_name=f"Claim SS benefits at age {claim_age}", index=False)
+        summary_data = {key: [row[key] for row in summary_rows] for key in summary_rows[0]}
         pd.DataFrame(summary_data).to_excel(writer, sheet_name="Summary Comparison", index=False)
     # --- Apply formatting ---
     wb = load_workbook(excel_file)
@@ -332,12 +873,185 @@ def analyze(
                 for row in range(2, ws.max_row + 1):
                     ws[f"{col_letter}{row}"].number_format = "$#,##0"
     wb.save(excel_file)
-    
+
+def format_sse(event, data):
+    """Encodes one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+# The simulation helpers read module-level parameters, so runs that set them must not interleave.
+simulation_lock = threading.Lock()
+
+def simulation_inputs(
+    birthdate: str = Query(...),
+    age_model1: int = Query(...),
+    age_model2: int = Query(...),
+    fra_benefit: float = Query(...),
+    inflation_rate_input: float = Query(...),
+    investment_return_input: float = Query(...),
+    filing_status: str = Query(...),
+    initial_401k_input: float = Query(...),
+    other_non_retirement_savings_input: float = Query(...),
+    target_income_input: float = Query(...),
+    non_retirement_gain_percentage_input: float = Query(...)
+):
+    """Query parameters shared by every simulation endpoint, used as a FastAPI dependency."""
+    return {
+        "birthdate": birthdate,
+        "age_model1": age_model1,
+        "age_model2": age_model2,
+        "fra_benefit": fra_benefit,
+        "inflation_rate_input": inflation_rate_input,
+        "investment_return_input": investment_return_input,
+        "filing_status": filing_status,
+        "initial_401k_input": initial_401k_input,
+        "other_non_retirement_savings_input": other_non_retirement_savings_input,
+        "target_income_input": target_income_input,
+        "non_retirement_gain_percentage_input": non_retirement_gain_percentage_input
+    }
+
+def apply_simulation_inputs(inputs):
+    """Publishes `inputs` via set_simulation_parameters; hold simulation_lock while calling."""
+    return set_simulation_parameters(
+        inputs["birthdate"], inputs["inflation_rate_input"], inputs["investment_return_input"],
+        inputs["filing_status"], inputs["initial_401k_input"], inputs["other_non_retirement_savings_input"],
+        inputs["target_income_input"], inputs["non_retirement_gain_percentage_input"])
+
+def run_locked(inputs, func, *args):
+    with simulation_lock:
+        apply_simulation_inputs(inputs)
+        return func(*args)
+
+# ========= FASTAPI APP SETUP =========
+@asynccontextmanager
+async def lifespan(app):
+    publish_reference_tables()
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.get("/analyze")
+def analyze(
+    session_id: str = Query(...),
+    inputs: dict = Depends(simulation_inputs)
+):
+    age_model1, age_model2, fra_benefit = inputs["age_model1"], inputs["age_model2"], inputs["fra_benefit"]
+    with simulation_lock:
+        computed_current_age = apply_simulation_inputs(inputs)
+
+        ages_local, years_local = get_age_ranges(computed_current_age)
+        benefit_percentage = get_benefit_percentage(years_local)
+
+        df_model1, summary_model1 = simulate_claim_age(age_model1, fra_benefit, ages_local, years_local, computed_current_age, benefit_percentage)
+        df_model2, summary_model2 = simulate_claim_age(age_model2, fra_benefit, ages_local, years_local, computed_current_age, benefit_percentage)
+
+        excel_file = f"social_security_analysis_{session_id}.xlsx"
+        write_excel_report(excel_file, {age_model1: df_model1, age_model2: df_model2}, [summary_model1, summary_model2])
+
     summary = {
         "Model1": df_model1.tail(1).to_dict(orient="records"),
         "Model2": df_model2.tail(1).to_dict(orient="records")
     }
     return summary
 
+@app.get("/analyze/stream")
+async def analyze_stream(
+    request: Request,
+    session_id: str = Query(...),
+    inputs: dict = Depends(simulation_inputs),
+    claim_ages: Optional[List[int]] = Query(None)
+):
+    """
+    Streaming variant of /analyze. Each claiming age runs in the thread pool and is
+    reported as a "result" event as soon as it finishes, preceded by "progress" events.
+    A final "complete" event carries the same summary /analyze returns, keyed Model1,
+    Model2, ... in claim-age order. Pass `claim_ages` to sweep more than the two models.
+    A failure ends the stream with an "error" event instead. Work stops at the next
+    step once the client disconnects.
+    """
+    models = claim_ages or [inputs["age_model1"], inputs["age_model2"]]
+    fra_benefit = inputs["fra_benefit"]
+    computed_current_age = get_current_age(inputs["birthdate"])
+    ages_local, years_local = get_age_ranges(computed_current_age)
+    benefit_percentage = get_benefit_percentage(years_local)
+    total_steps = len(models) + 1
+
+    async def event_stream():
+        tables = {}
+        summary_rows = []
+        summary = {}
+        try:
+            for step, claim_age in enumerate(models, start=1):
+                if await request.is_disconnected():
+                    return
+                yield format_sse("progress", {"completed": step - 1, "total": total_steps, "message": f"Simulating claim age {claim_age}"})
+                df, summary_row = await run_in_threadpool(
+                    run_locked, inputs, simulate_claim_age,
+                    claim_age, fra_benefit, ages_local, years_local, computed_current_age, benefit_percentage)
+                tables[claim_age] = df
+                summary_rows.append(summary_row)
+                summary[f"Model{step}"] = df.tail(1).to_dict(orient="records")
+                yield format_sse("result", {"claim_age": claim_age, "summary": summary_row, "final_row": summary[f"Model{step}"]})
+
+            if await request.is_disconnected():
+                return
+            yield format_sse("progress", {"completed": total_steps - 1, "total": total_steps, "message": "Writing Excel report"})
+            excel_file = f"social_security_analysis_{session_id}.xlsx"
+            await run_in_threadpool(write_excel_report, excel_file, tables, summary_rows)
+        except Exception as e:
+            # The 200 header is already sent, so failures are reported in-band.
+            yield format_sse("error", {"message": str(e)})
+            return
+        yield format_sse("complete", summary)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/optimize")
+def optimize(
+    inputs: dict = Depends(simulation_inputs),
+    claim_ages: Optional[List[int]] = Query(None),
+    objective: Literal["terminal_wealth", "lifetime_tax"] = Query("terminal_wealth"),
+    grid_points: int = Query(41, ge=3, le=61)
+):
+    """
+    Optimized yearly 401(k) withdrawals and Roth-style conversions for each claiming
+    age, next to the fixed withdrawal order /analyze uses.
+    """
+    computed_current_age = get_current_age(inputs["birthdate"])
+    # One claiming age per lock hold, so other requests can run in between.
+    results = [
+        run_locked(inputs, optimize_withdrawals, claim_age, inputs["fra_benefit"], computed_current_age, objective, grid_points)
+        for claim_age in claim_ages or [inputs["age_model1"], inputs["age_model2"]]
+    ]
+    return {"results": results}
+
+@app.get("/sensitivity")
+def sensitivity(
+    inputs: dict = Depends(simulation_inputs),
+    claim_ages: Optional[List[int]] = Query(None),
+    perturbation: float = Query(0.10, gt=0, lt=1)
+):
+    """
+    Tornado-chart sensitivity of the final portfolio and lifetime taxes to inflation,
+    investment return, target income, FRA benefit and the trust-fund
+    benefit_reduction_factor, for each claiming age.
+    """
+    results = run_locked(
+        inputs, run_sensitivity_analysis,
+        claim_ages or [inputs["age_model1"], inputs["age_model2"]], inputs["fra_benefit"],
+        get_current_age(inputs["birthdate"]), perturbation)
+    return {"perturbation": perturbation, "results": results}
+
 if __name__ == "__main__":
     uvicorn.run("fastapi_app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -1,6 +1,8 @@
 import streamlit as st
 import requests
+import json
 import pandas as pd
+import altair as alt
 import uuid  # For generating unique session IDs
 
 st.title("Social Security Claiming Strategies")
@@ -85,11 +87,79 @@ non_retirement_gain_percentage = st.number_input(
 session_id = str(uuid.uuid4())
 
 if st.button("Run Analysis"):
-    with st.spinner("Running simulation..."):
+    progress_bar = st.progress(0.0, text="Running simulation...")
+    try:
+        url = (
+            f"http://localhost:8000/analyze/stream?session_id={session_id}"
+            f"&birthdate={birthdate}"
+            f"&age_model1={int(age_model1)}"
+            f"&age_model2={int(age_model2)}"
+            f"&fra_benefit={fra_benefit}"
+            f"&inflation_rate_input={inflation_rate}"
+            f"&investment_return_input={investment_return}"
+            f"&filing_status={filing_status}"
+            f"&initial_401k_input={initial_401k}"
+            f"&other_non_retirement_savings_input={other_non_retirement_savings}"
+            f"&target_income_input={target_income}"
+            f"&non_retirement_gain_percentage_input={non_retirement_gain_percentage}"
+        )
+        # The backend streams server-sent events: "progress" while it works, one
+        # "result" per claiming age as it finishes, then "complete" (or "error").
+        with requests.get(url, stream=True) as response:
+            if response.status_code == 200:
+                st.subheader("Summary Results")
+                event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: "):
+                        data = json.loads(line[len("data: "):])
+                        if event == "progress":
+                            progress_bar.progress(data["completed"] / data["total"], text=data["message"])
+                        elif event == "result":
+                            st.markdown(f"### Claim SS benefits at age {data['claim_age']}")
+                            st.dataframe(pd.DataFrame(data["final_row"]))
+                        elif event == "complete":
+                            progress_bar.progress(1.0, text="Analysis complete!")
+                            st.success("Analysis complete!")
+                        elif event == "error":
+                            st.error(f"Error: {data['message']}")
+            else:
+                st.error(f"Error: {response.status_code}")
+    except Exception as e:
+        st.error(f"Error connecting to FastAPI backend: {e}")
+
+    file_name = f"social_security_analysis_{session_id}.xlsx"
+    try:
+        with open(file_name, "rb") as file:
+            excel_bytes = file.read()
+        st.download_button(
+            label="Download Excel Spreadsheet",
+            data=excel_bytes,
+            file_name=file_name,
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+    except Exception as e:
+        st.info("Excel file not available yet. Please try again in a moment.")
+
+st.markdown("## Sensitivity Analysis")
+st.markdown("""
+See which assumption matters most. Each input is moved down and up by the chosen 
+percentage, and the bars show the resulting range of the final portfolio.
+""")
+perturbation = st.number_input(
+    "Perturbation (decimal):", 
+    min_value=0.01, 
+    max_value=0.50, 
+    value=0.10,
+    help="How far each input is moved down and up, as a fraction of its value (e.g., 0.10 for ±10%)."
+)
+
+if st.button("Run Sensitivity Analysis"):
+    with st.spinner("Running sensitivity analysis..."):
         try:
             url = (
-                f"http://localhost:8000/analyze?session_id={session_id}"
-                f"&birthdate={birthdate}"
+                f"http://localhost:8000/sensitivity?birthdate={birthdate}"
                 f"&age_model1={int(age_model1)}"
                 f"&age_model2={int(age_model2)}"
                 f"&fra_benefit={fra_benefit}"
@@ -100,34 +170,27 @@ if st.button("Run Analysis"):
                 f"&other_non_retirement_savings_input={other_non_retirement_savings}"
                 f"&target_income_input={target_income}"
                 f"&non_retirement_gain_percentage_input={non_retirement_gain_percentage}"
+                f"&perturbation={perturbation}"
             )
             response = requests.get(url)
             if response.status_code == 200:
-                data = response.json()
-                st.success("Analysis complete!")
-                
-                st.subheader("Summary Results")
-                df_model1 = pd.DataFrame(data["Model1"])
-                df_model2 = pd.DataFrame(data["Model2"])
-                
-                st.markdown(f"### Claim SS benefits at age {int(age_model1)}")
-                st.dataframe(df_model1)
-                st.markdown(f"### Claim SS benefits at age {int(age_model2)}")
-                st.dataframe(df_model2)
+                for result in response.json()["results"]:
+                    st.markdown(f"### Claim SS benefits at age {result['claim_age']}")
+                    df_inputs = pd.DataFrame(result["inputs"])
+                    # Inputs arrive ranked by swing, so keep that order for the tornado.
+                    tornado = alt.Chart(df_inputs).mark_bar().encode(
+                        x=alt.X("final_portfolio_low:Q", title="Final Portfolio Total (2025$)"),
+                        x2="final_portfolio_high:Q",
+                        y=alt.Y("input:N", sort=None, title=None)
+                    )
+                    base_line = alt.Chart(pd.DataFrame({"base": [result["final_portfolio"]]})).mark_rule().encode(x="base:Q")
+                    st.altair_chart(tornado + base_line)
+                    st.dataframe(df_inputs[[
+                        "input", "final_portfolio_elasticity", "lifetime_taxes_elasticity",
+                        "final_portfolio_low", "final_portfolio_high",
+                        "lifetime_taxes_low", "lifetime_taxes_high"
+                    ]])
             else:
                 st.error(f"Error: {response.status_code}")
         except Exception as e:
             st.error(f"Error connecting to FastAPI backend: {e}")
-
-    file_name = f"social_security_analysis_{session_id}.xlsx"
-    try:
-        with open(file_name, "rb") as file:
-            excel_bytes = file.read()
-        st.download_button(
-            label="Download Excel Spreadsheet",
-            data=excel_bytes,
-            file_name=file_name,
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-    except Exception as e:
-        st.info("Excel file not available yet. Please try again in a moment.")
\ No newline at end of file
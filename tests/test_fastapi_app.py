@@ -1,10 +1,13 @@
+import json
 import os
+import sqlite3
 import sys
+import tempfile
 import unittest
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch, mock_open, MagicMock, AsyncMock
 from fastapi.testclient import TestClient
 
 # Add the src directory to the Python path
@@ -21,6 +24,23 @@ class TestFastAPIApp(unittest.TestCase):
         # Mock data for tests
         self.mock_tax_data = "0,10275,0.1\n10275,41775,0.12\n41775,89075,0.22\n89075,170050,0.24\n170050,215950,0.32\n215950,539900,0.35\n539900,999999999,0.37"
         self.mock_rmd_data = "73,25.5\n74,24.7\n75,23.9\n76,23.1\n77,22.3\n78,21.5\n79,20.8\n80,20.0\n120+,2.0"
+        self.reference_tables = {
+            "tax_brackets": src.fastapi_app.parse_tax_brackets(self.mock_tax_data.splitlines()),
+            "rmd_divisors": src.fastapi_app.parse_rmd_table(self.mock_rmd_data.splitlines())
+        }
+        self.endpoint_params = {
+            "birthdate": "1960-01-01",
+            "age_model1": 62,
+            "age_model2": 70,
+            "fra_benefit": 30000,
+            "inflation_rate_input": 0.03,
+            "investment_return_input": 0.06,
+            "filing_status": "Single",
+            "initial_401k_input": 1500000,
+            "other_non_retirement_savings_input": 500000,
+            "target_income_input": 60000,
+            "non_retirement_gain_percentage_input": 0.5
+        }
 
     def test_compute_adjusted_benefit(self):
         # Test early claiming
@@ -173,5 +193,244 @@ class TestFastAPIApp(unittest.TestCase):
         except Exception as e:
             self.skipTest(f"Endpoint test failed: {str(e)}")
 
+    def stream_events(self, params):
+        with client.stream("GET", "/analyze/stream", params=params) as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+            body = "".join(response.iter_text())
+        events = []
+        for block in body.strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in block.splitlines())
+            events.append((lines["event"], json.loads(lines["data"])))
+        return events
+
+    @patch("src.fastapi_app.write_excel_report")
+    def test_analyze_stream_endpoint(self, mock_write_report):
+        events = self.stream_events(dict(self.endpoint_params, session_id="test123", claim_ages=[62, 67, 70]))
+        results = [data for name, data in events if name == "result"]
+        self.assertEqual([r["claim_age"] for r in results], [62, 67, 70])
+        self.assertEqual(events[-1][0], "complete")
+        self.assertEqual(set(events[-1][1]), {"Model1", "Model2", "Model3"})
+        self.assertEqual(events[-1][1]["Model2"], results[1]["final_row"])
+        mock_write_report.assert_called_once()
+        self.assertEqual(list(mock_write_report.call_args[0][1]), [62, 67, 70])
+
+    @patch("src.fastapi_app.write_excel_report", side_effect=OSError("disk full"))
+    def test_analyze_stream_reports_errors(self, mock_write_report):
+        events = self.stream_events(dict(self.endpoint_params, session_id="test123"))
+        self.assertEqual(events[-1], ("error", {"message": "disk full"}))
+        self.assertNotIn("complete", [name for name, _ in events])
+
+    @patch("src.fastapi_app.write_excel_report")
+    def test_analyze_stream_stops_on_disconnect(self, mock_write_report):
+        with patch("src.fastapi_app.simulate_claim_age", wraps=src.fastapi_app.simulate_claim_age) as mock_simulate:
+            # The client goes away once the first result has been produced.
+            with patch("starlette.requests.Request.is_disconnected",
+                       new=AsyncMock(side_effect=lambda: mock_simulate.call_count > 0)):
+                events = self.stream_events(dict(self.endpoint_params, session_id="test123", claim_ages=[62, 67, 70]))
+        self.assertEqual([name for name, _ in events], ["progress", "result"])
+        mock_simulate.assert_called_once()
+        mock_write_report.assert_not_called()
+
+    def test_publish_reference_tables(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+             patch.object(src.fastapi_app, "shared_data_dir", os.path.join(tmp_dir, "shared")), \
+             patch.dict(src.fastapi_app.reference_tables, clear=True), \
+             patch.dict(src.fastapi_app.reference_table_digests, clear=True):
+            tax_file = os.path.join(tmp_dir, "tax.txt")
+            with open(tax_file, "w") as file:
+                file.write(self.mock_tax_data)
+            rmd_file = os.path.join(tmp_dir, "rmd.txt")
+            with open(rmd_file, "w") as file:
+                file.write(self.mock_rmd_data)
+
+            self.assertTrue(src.fastapi_app.publish_reference_table("tax_brackets", tax_file, src.fastapi_app.parse_tax_brackets))
+            self.assertTrue(src.fastapi_app.publish_reference_table("rmd_divisors", rmd_file, src.fastapi_app.parse_rmd_table))
+            self.assertFalse(src.fastapi_app.publish_reference_table("missing", os.path.join(tmp_dir, "missing.txt"), src.fastapi_app.parse_tax_brackets))
+            self.assertEqual(len(os.listdir(os.path.join(tmp_dir, "shared"))), 2)
+
+            # A second worker attaches to the published file instead of writing its own copy.
+            src.fastapi_app.publish_reference_table("tax_brackets", tax_file, src.fastapi_app.parse_tax_brackets)
+            self.assertEqual(len(os.listdir(os.path.join(tmp_dir, "shared"))), 2)
+            self.assertIsInstance(src.fastapi_app.reference_tables["tax_brackets"], np.memmap)
+
+            # Published tables are used without reopening the source files.
+            with patch("builtins.open", side_effect=FileNotFoundError):
+                self.assertAlmostEqual(calculate_federal_income_tax(20000), 10275 * 0.1 + (20000 - 10275) * 0.12)
+                self.assertAlmostEqual(calculate_rmd(74, 100000), 100000 / 24.7)
+                self.assertAlmostEqual(calculate_rmd(90, 100000), 100000 / 2.0)
+
+            # A new parser version publishes fresh arrays instead of reusing the old ones.
+            with patch.object(src.fastapi_app, "reference_table_version", src.fastapi_app.reference_table_version + 1):
+                src.fastapi_app.publish_reference_table("tax_brackets", tax_file, src.fastapi_app.parse_tax_brackets)
+            self.assertEqual(len(os.listdir(os.path.join(tmp_dir, "shared"))), 3)
+
+    @unittest.skipUnless(hasattr(os, "getuid"), "directory ownership checks are POSIX-only")
+    def test_publish_reference_table_requires_private_dir(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+             patch.object(src.fastapi_app, "shared_data_dir", os.path.join(tmp_dir, "shared")), \
+             patch.dict(src.fastapi_app.reference_tables, clear=True), \
+             patch.dict(src.fastapi_app.reference_table_digests, clear=True):
+            tax_file = os.path.join(tmp_dir, "tax.txt")
+            with open(tax_file, "w") as file:
+                file.write(self.mock_tax_data)
+            os.makedirs(os.path.join(tmp_dir, "shared"))
+            os.chmod(os.path.join(tmp_dir, "shared"), 0o777)
+            self.assertFalse(src.fastapi_app.publish_reference_table("tax_brackets", tax_file, src.fastapi_app.parse_tax_brackets))
+            self.assertNotIn("tax_brackets", src.fastapi_app.reference_tables)
+            self.assertEqual(os.listdir(os.path.join(tmp_dir, "shared")), [])
+
+    def test_publish_reference_table_falls_back_when_unwritable(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+             patch.dict(src.fastapi_app.reference_tables, clear=True), \
+             patch.dict(src.fastapi_app.reference_table_digests, clear=True):
+            tax_file = os.path.join(tmp_dir, "tax.txt")
+            with open(tax_file, "w") as file:
+                file.write(self.mock_tax_data)
+            # shared_data_dir cannot be created under a regular file.
+            with patch.object(src.fastapi_app, "shared_data_dir", os.path.join(tax_file, "shared")):
+                self.assertFalse(src.fastapi_app.publish_reference_table("tax_brackets", tax_file, src.fastapi_app.parse_tax_brackets))
+
+            # A failed write leaves no temp file behind.
+            shared_dir = os.path.join(tmp_dir, "shared")
+            with patch.object(src.fastapi_app, "shared_data_dir", shared_dir), \
+                 patch("src.fastapi_app.np.save", side_effect=OSError("disk full")):
+                self.assertFalse(src.fastapi_app.publish_reference_table("tax_brackets", tax_file, src.fastapi_app.parse_tax_brackets))
+            self.assertEqual(os.listdir(shared_dir), [])
+            self.assertNotIn("tax_brackets", src.fastapi_app.reference_tables)
+            self.assertNotIn("tax_brackets", src.fastapi_app.reference_table_digests)
+
+    def test_result_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+             patch.object(src.fastapi_app, "result_cache_path", os.path.join(tmp_dir, "results.sqlite")):
+            curr_age = src.fastapi_app.set_simulation_parameters(
+                "1960-01-01", 0.02, 0.05, "Single", 1000000, 250000, 50000, 0.25)
+            ages, years = get_age_ranges(curr_age)
+            benefit_percentage = src.fastapi_app.get_benefit_percentage(years)
+            df, summary_row = src.fastapi_app.simulate_claim_age(67, 2000, ages, years, curr_age, benefit_percentage)
+
+            with patch("src.fastapi_app.run_claim_strategy", side_effect=AssertionError("cache miss")):
+                cached_df, cached_row = src.fastapi_app.simulate_claim_age(67, 2000, ages, years, curr_age, benefit_percentage)
+            pd.testing.assert_frame_equal(df, cached_df)
+            self.assertEqual(summary_row, cached_row)
+
+            # Results are stored as plain JSON, which cannot run code when read back.
+            conn = sqlite3.connect(os.path.join(tmp_dir, "results.sqlite"))
+            stored = conn.execute("SELECT value FROM simulation_results").fetchone()[0]
+            conn.close()
+            self.assertEqual(set(json.loads(stored)), {"table", "summary_row"})
+
+            # Any change to the inputs is a different key.
+            src.fastapi_app.set_simulation_parameters(
+                "1960-01-01", 0.03, 0.05, "Single", 1000000, 250000, 50000, 0.25)
+            with patch("src.fastapi_app.run_claim_strategy", side_effect=AssertionError("cache miss")):
+                with self.assertRaises(AssertionError):
+                    src.fastapi_app.simulate_claim_age(67, 2000, ages, years, curr_age, benefit_percentage)
+
+            # Results written by another cache version are never served.
+            with patch.object(src.fastapi_app, "result_cache_version", src.fastapi_app.result_cache_version + 1), \
+                 patch("src.fastapi_app.run_claim_strategy", side_effect=AssertionError("cache miss")):
+                with self.assertRaises(AssertionError):
+                    src.fastapi_app.simulate_claim_age(67, 2000, ages, years, curr_age, benefit_percentage)
+
+    def test_result_cache_evicts_oldest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+             patch.object(src.fastapi_app, "result_cache_path", os.path.join(tmp_dir, "results.sqlite")), \
+             patch.object(src.fastapi_app, "result_cache_max_entries", 2):
+            for n in range(3):
+                src.fastapi_app.result_cache_set(f"key{n}", n)
+            self.assertIsNone(src.fastapi_app.result_cache_get("key0"))
+            self.assertEqual(src.fastapi_app.result_cache_get("key1"), 1)
+            self.assertEqual(src.fastapi_app.result_cache_get("key2"), 2)
+
+    def test_run_claim_strategy_batch_matches_scalar(self):
+        with patch.dict(src.fastapi_app.reference_tables, self.reference_tables):
+            curr_age = src.fastapi_app.set_simulation_parameters(
+                "1955-01-01", 0.03, 0.06, "Single", 800000, 200000, 90000, 0.5)
+            ages, years = get_age_ranges(curr_age)
+            claim_ages = [70, 70, 72]
+            benefits = [compute_adjusted_benefit(30000, claim_age) for claim_age in claim_ages]
+            batch = src.fastapi_app.run_claim_strategy_batch(
+                ages, curr_age, claim_ages, benefits, [0.03, 0.03, 0.03], [0.06, 0.06, 0.06],
+                [90000, 90000, 90000], [0.75, 0.75, 0.75])
+            for n, claim_age in enumerate(claim_ages):
+                scalar = run_claim_strategy(ages, years, claim_age, benefits[n], curr_age)
+                for scalar_series, batch_series in zip(scalar, batch):
+                    np.testing.assert_allclose(batch_series[n], scalar_series, rtol=1e-9, atol=1e-6)
+
+    def test_sensitivity_endpoint(self):
+        response = client.get("/sensitivity", params=dict(self.endpoint_params, perturbation=0.1))
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([r["claim_age"] for r in results], [62, 70])
+        for result in results:
+            inputs = {item["input"]: item for item in result["inputs"]}
+            self.assertEqual(set(inputs), {"inflation_rate", "investment_return", "target_income", "fra_benefit", "benefit_reduction_factor"})
+            swings = [abs(item["final_portfolio_high"] - item["final_portfolio_low"]) for item in result["inputs"]]
+            self.assertEqual(swings, sorted(swings, reverse=True))
+            self.assertGreater(inputs["investment_return"]["final_portfolio_elasticity"], 0)
+            self.assertLess(inputs["target_income"]["final_portfolio_elasticity"], 0)
+            self.assertGreater(inputs["target_income"]["lifetime_taxes_elasticity"], 0)
+            self.assertAlmostEqual(inputs["fra_benefit"]["high_value"], 33000)
+
+        # Post-depletion benefits never exceed scheduled benefits, however large the perturbation.
+        response = client.get("/sensitivity", params=dict(self.endpoint_params, perturbation=0.9))
+        self.assertEqual(response.status_code, 200)
+        for result in response.json()["results"]:
+            factor = next(item for item in result["inputs"] if item["input"] == "benefit_reduction_factor")
+            self.assertEqual(factor["high_value"], 1.0)
+            self.assertAlmostEqual(factor["low_value"], factor["base_value"] * 0.1)
+
+        for perturbation in (0, 1, 1.5):
+            response = client.get("/sensitivity", params=dict(self.endpoint_params, perturbation=perturbation))
+            self.assertEqual(response.status_code, 422)
+
+    def test_optimize_withdrawals(self):
+        with patch.dict(src.fastapi_app.reference_tables, self.reference_tables):
+            curr_age = src.fastapi_app.set_simulation_parameters(
+                "1960-01-01", 0.03, 0.06, "Single", 1500000, 500000, 60000, 0.5)
+            wealth = src.fastapi_app.optimize_withdrawals(70, 30000, curr_age, "terminal_wealth")
+            taxes = src.fastapi_app.optimize_withdrawals(70, 30000, curr_age, "lifetime_tax")
+            curr_age = src.fastapi_app.set_simulation_parameters(
+                "1960-01-01", 0.03, 0.06, "Single", 5000000, 1000000, 200000, 0.5)
+            large = src.fastapi_app.optimize_withdrawals(67, 30000, curr_age, "terminal_wealth")
+
+        schedule = pd.DataFrame(wealth["schedule"])
+        self.assertEqual(len(schedule), len(get_age_ranges(curr_age)[0]))
+        self.assertTrue((schedule["401k Withdrawals (2025$)"] >= schedule["RMDs (2025$)"] - 1e-6).all())
+        self.assertTrue((schedule["401k Balance (2025$)"] >= -1e-6).all())
+        self.assertEqual(wealth["total_shortfall"], 0)
+        self.assertEqual(wealth["policy"], "optimized")
+        self.assertLess(taxes["lifetime_taxes"], taxes["baseline"]["lifetime_taxes"])
+        self.assertLessEqual(taxes["lifetime_taxes"], wealth["lifetime_taxes"])
+        # The returned policy never scores below the fixed withdrawal order on the objective.
+        for result in (wealth, taxes, large):
+            self.assertGreaterEqual(result["score"], result["baseline"]["score"])
+
+    def test_optimize_withdrawals_negative_real_return(self):
+        with patch.dict(src.fastapi_app.reference_tables, self.reference_tables):
+            curr_age = src.fastapi_app.set_simulation_parameters(
+                "1958-01-01", 0.05, 0.02, "Single", 2000000, 100000, 100000, 0.5)
+            for objective in ("terminal_wealth", "lifetime_tax"):
+                result = src.fastapi_app.optimize_withdrawals(62, 30000, curr_age, objective)
+                schedule = pd.DataFrame(result["schedule"]).drop(columns=["Age", "Year"])
+                # Balances, withdrawals and shortfalls never go negative when savings shrink in real terms.
+                self.assertTrue((schedule >= 0).all().all(), objective)
+
+    def test_optimize_endpoint(self):
+        params = dict(self.endpoint_params, grid_points=21)
+        response = client.get("/optimize", params=params)
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([r["claim_age"] for r in results], [62, 70])
+        self.assertEqual(results[0]["objective"], "terminal_wealth")
+        self.assertIn(results[0]["policy"], ("optimized", "fixed_order"))
+        self.assertIn("Conversion Deposited (2025$)", results[0]["schedule"][0])
+
+        response = client.get("/optimize", params=dict(params, objective="max_spending"))
+        self.assertEqual(response.status_code, 422)
+        response = client.get("/optimize", params=dict(params, grid_points=62))
+        self.assertEqual(response.status_code, 422)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file